@@ -1,9 +1,11 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
 import os
+import uuid
+import shutil
 import zipfile
 import tempfile
 import asyncio
@@ -11,10 +13,14 @@ import aiofiles
 from pathlib import Path
 import logging
 from datetime import datetime
+from contextlib import nullcontext
 
 from services.chatgpt_service import ChatGPTService
 from services.comic_generator import ComicGenerator
 from services.pdf_generator import PDFGenerator
+from services.page_composer import PageComposer, LAYOUTS
+from services.tracing import start_trace, span, profile_to, is_profiling_requested
+from services.jobs import JobRegistry, metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -35,14 +41,28 @@ app.add_middleware(
 chatgpt_service = ChatGPTService()
 comic_generator = ComicGenerator()
 pdf_generator = PDFGenerator()
+page_composer = PageComposer()
+job_registry = JobRegistry()
 
 class ComicRequest(BaseModel):
     genre: str
     setting: str
     characters: str
+    num_panels: int = Field(default=10, ge=1, le=100)
 
 class GenerateComicRequest(BaseModel):
     prompts: List[dict]  # Each prompt is an object with description and dialogue
+    layout: Optional[str] = None  # Page layout name from the frontend, or "random"; None keeps the 2x2 grid PDF
+    job_id: Optional[str] = None  # Client-chosen id so the job can be cancelled via /cancel/{job_id}
+    draft: bool = False  # Return fast low-step previews first and refine them in the background
+
+    @field_validator("layout")
+    @classmethod
+    def check_layout(cls, layout: Optional[str]) -> Optional[str]:
+        # Reject unknown layouts up front, before any panel is rendered
+        if layout is not None and layout != "random" and layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout {layout!r}, expected one of: random, {', '.join(LAYOUTS)}")
+        return layout
 
 class PanelPrompt(BaseModel):
     description: str
@@ -51,81 +71,261 @@ class PanelPrompt(BaseModel):
 class ComicResponse(BaseModel):
     success: bool
     message: str
+    job_id: Optional[str] = None
+    status: Optional[str] = None
     zip_url: Optional[str] = None
     pdf_url: Optional[str] = None
     error: Optional[str] = None
     prompts: Optional[List[PanelPrompt]] = None
+    trace: Optional[dict] = None
+    trace_url: Optional[str] = None
+    profile_url: Optional[str] = None
 
 @app.get("/")
 async def root():
     return {"message": "AI Comic Factory API is running!"}
 
 @app.post("/generate-prompts", response_model=ComicResponse)
-async def generate_prompts(request: ComicRequest):
-    """Generate 10 illustration prompts and dialogue using ChatGPT based on user input"""
+async def generate_prompts(
+    request: ComicRequest,
+    background_tasks: BackgroundTasks,
+    x_profile: Optional[str] = Header(default=None)
+):
+    """Generate illustration prompts and dialogue using ChatGPT based on user input"""
+    profile_dir = None
     try:
-        logger.info(f"Generating prompts for genre: {request.genre}, setting: {request.setting}")
-        prompts = await chatgpt_service.generate_illustration_prompts(
-            genre=request.genre,
-            setting=request.setting,
-            characters=request.characters
-        )
+        logger.info(f"Generating {request.num_panels} prompts for genre: {request.genre}, setting: {request.setting}")
+        if is_profiling_requested(x_profile):
+            profile_dir = tempfile.mkdtemp(prefix="profile_")
+        # File names carry the trace id, since /download matches by name across all temp dirs
+        with start_trace("generate-prompts") as trace, (
+            profile_to(os.path.join(profile_dir, f"profile_{trace.trace_id}.txt")) if profile_dir else nullcontext()
+        ) as profile_path:
+            prompts = await chatgpt_service.generate_illustration_prompts(
+                genre=request.genre,
+                setting=request.setting,
+                characters=request.characters,
+                num_panels=request.num_panels
+            )
         # prompts is a list of dicts with description and dialogue
         panel_prompts = [PanelPrompt(**p) for p in prompts]
+        if profile_dir:
+            background_tasks.add_task(cleanup_temp_files, profile_dir, 3600)
         return {
             "success": True,
             "message": "Prompts generated successfully",
-            "prompts": panel_prompts
+            "prompts": panel_prompts,
+            "trace": trace.to_dict(),
+            "profile_url": f"/download/{os.path.basename(profile_path)}" if profile_path else None
         }
     except Exception as e:
         logger.error(f"Error generating prompts: {str(e)}")
+        # Background tasks don't run for error responses, so remove the profile dir here
+        if profile_dir:
+            shutil.rmtree(profile_dir, ignore_errors=True)
         raise HTTPException(status_code=500, detail=f"Failed to generate prompts: {str(e)}")
 
 @app.post("/generate-comic", response_model=ComicResponse)
-async def generate_comic(request: GenerateComicRequest, background_tasks: BackgroundTasks):
+async def generate_comic(
+    request: GenerateComicRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    x_profile: Optional[str] = Header(default=None)
+):
     """Generate comic images from prompts and return ZIP file (TEMP: only 2 images for dev)"""
     try:
         logger.info(f"Generating comic with {len(request.prompts)} prompts")
         prompts_to_use = request.prompts[:2]
         if len(prompts_to_use) != 2:
             raise HTTPException(status_code=400, detail="Exactly 2 prompts are required for dev mode")
+        job_id = request.job_id or uuid.uuid4().hex
+        if job_id in job_registry.tasks:
+            raise HTTPException(status_code=409, detail=f"Job {job_id} is already running")
+        if job_registry.get_state(job_id):
+            # Finished draft jobs keep their status until their files expire
+            raise HTTPException(status_code=409, detail=f"Job id {job_id} is already in use by a finished job")
         temp_dir = tempfile.mkdtemp(prefix="comic_")
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        # Extract descriptions and dialogues
-        descriptions = [p['description'] for p in prompts_to_use]
-        dialogues = [p['dialogue'] for p in prompts_to_use]
-        # Generate images with dialogue overlays
+        profile_requested = is_profiling_requested(x_profile)
+        # Filled in as panels finish, so a cancelled job can report how much work it threw away
         image_paths = []
-        for i, (desc, dialogue) in enumerate(zip(descriptions, dialogues)):
-            image_path = await comic_generator._generate_with_replicate(desc, temp_dir, i+1, dialogue)
-            image_paths.append(image_path)
-        zip_filename = f"comic_{timestamp}.zip"
-        zip_path = os.path.join(temp_dir, zip_filename)
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for i, image_path in enumerate(image_paths):
-                if os.path.exists(image_path):
-                    zipf.write(image_path, f"panel_{i+1:02d}.png")
-        pdf_filename = f"comic_{timestamp}.pdf"
-        pdf_path = os.path.join(temp_dir, pdf_filename)
-        await pdf_generator.create_comic_pdf(
-            image_paths=image_paths,
-            prompts=descriptions,
-            output_path=pdf_path
-        )
-        with zipfile.ZipFile(zip_path, 'a') as zipf:
-            zipf.write(pdf_path, pdf_filename)
+        cancel_reason = None
+        try:
+            # File names carry the trace id, since /download matches by name across all temp dirs
+            with start_trace("generate-comic") as trace, (
+                profile_to(os.path.join(temp_dir, f"profile_{trace.trace_id}.txt")) if profile_requested else nullcontext()
+            ) as profile_path:
+                job = asyncio.create_task(render_comic(request, prompts_to_use, temp_dir, timestamp, image_paths))
+                job_registry.register(job_id, job)
+                metrics["jobs_started"] += 1
+                watcher = asyncio.create_task(job_registry.watch_disconnect(job_id, http_request))
+                try:
+                    zip_filename, pdf_filename = await job
+                except asyncio.CancelledError:
+                    # Either the job was cancelled, or this request itself was; make sure no work is left running
+                    job.cancel()
+                    cancel_reason = job_registry.cancel_reason(job_id)
+                    raise
+                finally:
+                    watcher.cancel()
+                    job_registry.unregister(job_id)
+        except asyncio.CancelledError:
+            # The trace and profiler have exited by now, so nothing writes into temp_dir anymore
+            metrics["jobs_cancelled"] += 1
+            metrics["panels_wasted"] += len(image_paths)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            logger.info(f"Comic job {job_id} cancelled ({cancel_reason or 'request cancelled'}), discarded {len(image_paths)} rendered panels")
+            if cancel_reason is None:
+                raise
+            raise HTTPException(status_code=499, detail=f"Comic generation cancelled: {cancel_reason}")
+        metrics["jobs_completed"] += 1
+        metrics["panels_completed"] += len(image_paths)
+        trace_filename = f"trace_{trace.trace_id}.json"
+        trace.export(os.path.join(temp_dir, trace_filename))
+        status = "completed"
+        if request.draft:
+            status = "refining"
+            job_registry.set_state(job_id, status)
+            job_registry.register(job_id, asyncio.create_task(
+                refine_comic(job_id, request, prompts_to_use, temp_dir, timestamp)
+            ))
         await asyncio.sleep(1)
-        background_tasks.add_task(cleanup_temp_files, temp_dir, 3600)
+        background_tasks.add_task(cleanup_temp_files, temp_dir, 3600, job_id)
         return ComicResponse(
             success=True,
-            message="Comic generated successfully",
+            message="Draft comic generated, refining in background" if request.draft else "Comic generated successfully",
+            job_id=job_id,
+            status=status,
             zip_url=f"/download/{zip_filename}",
-            pdf_url=f"/download/{pdf_filename}"
+            pdf_url=f"/download/{pdf_filename}",
+            trace=trace.to_dict(),
+            trace_url=f"/download/{trace_filename}",
+            profile_url=f"/download/{os.path.basename(profile_path)}" if profile_path else None
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generating comic: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to generate comic: {str(e)}")
 
+async def render_comic(
+    request: GenerateComicRequest,
+    prompts_to_use: List[dict],
+    temp_dir: str,
+    timestamp: str,
+    image_paths: List[str]
+) -> tuple:
+    """Render panels and assemble the ZIP and PDF; runs as a cancellable job"""
+    # Extract descriptions and dialogues
+    descriptions = [p['description'] for p in prompts_to_use]
+    dialogues = [p['dialogue'] for p in prompts_to_use]
+    preset = "draft" if request.draft else "full"
+    # Generate images with dialogue overlays
+    for i, (desc, dialogue) in enumerate(zip(descriptions, dialogues)):
+        image_path = await comic_generator._generate_with_replicate(desc, temp_dir, i+1, dialogue, preset=preset)
+        image_paths.append(image_path)
+    return await assemble_comic(request, descriptions, image_paths, temp_dir, timestamp)
+
+async def assemble_comic(
+    request: GenerateComicRequest,
+    descriptions: List[str],
+    image_paths: List[str],
+    temp_dir: str,
+    timestamp: str
+) -> tuple:
+    """Build the ZIP and PDF next to their final names and swap them in atomically"""
+    zip_filename = f"comic_{timestamp}.zip"
+    zip_path = os.path.join(temp_dir, zip_filename)
+    zip_tmp_path = zip_path + ".tmp"
+    with span("zip.panels"):
+        with zipfile.ZipFile(zip_tmp_path, 'w') as zipf:
+            for i, image_path in enumerate(image_paths):
+                if os.path.exists(image_path):
+                    zipf.write(image_path, f"panel_{i+1:02d}.png")
+    pdf_filename = f"comic_{timestamp}.pdf"
+    pdf_path = os.path.join(temp_dir, pdf_filename)
+    pdf_tmp_path = pdf_path + ".tmp"
+    if request.layout:
+        page_paths = await page_composer.compose_pages(image_paths, temp_dir, request.layout)
+        with span("zip.pages"):
+            with zipfile.ZipFile(zip_tmp_path, 'a') as zipf:
+                for page_path in page_paths:
+                    zipf.write(page_path, os.path.basename(page_path))
+        await asyncio.to_thread(pdf_generator.create_pages_pdf, page_paths, pdf_tmp_path)
+    else:
+        await pdf_generator.create_comic_pdf(
+            image_paths=image_paths,
+            prompts=descriptions,
+            output_path=pdf_tmp_path
+        )
+    with span("zip.pdf"):
+        with zipfile.ZipFile(zip_tmp_path, 'a') as zipf:
+            zipf.write(pdf_tmp_path, pdf_filename)
+    os.replace(pdf_tmp_path, pdf_path)
+    os.replace(zip_tmp_path, zip_path)
+    return zip_filename, pdf_filename
+
+async def refine_comic(
+    job_id: str,
+    request: GenerateComicRequest,
+    prompts_to_use: List[dict],
+    temp_dir: str,
+    timestamp: str
+):
+    """Replace each draft panel with a full-quality render, then rebuild the ZIP and PDF"""
+    descriptions = [p['description'] for p in prompts_to_use]
+    dialogues = [p['dialogue'] for p in prompts_to_use]
+    try:
+        results = await asyncio.gather(*[
+            comic_generator.refine_panel(desc, temp_dir, i+1, dialogue)
+            for i, (desc, dialogue) in enumerate(zip(descriptions, dialogues))
+        ], return_exceptions=True)
+        # A panel whose refinement failed keeps its draft, which still sits at the same path
+        image_paths = [os.path.join(temp_dir, f"panel_{i+1:02d}.png") for i in range(len(results))]
+        failed = [i + 1 for i, result in enumerate(results) if isinstance(result, BaseException)]
+        for panel_number in failed:
+            logger.error(f"Error refining panel {panel_number} of comic {job_id}: {str(results[panel_number - 1])}")
+        metrics["panels_refined"] += len(results) - len(failed)
+        metrics["panels_refine_failed"] += len(failed)
+        await assemble_comic(request, descriptions, image_paths, temp_dir, timestamp)
+        if not failed:
+            state = "completed"
+        elif len(failed) < len(results):
+            state = "partial"
+        else:
+            state = "failed"
+        job_registry.set_state(job_id, state)
+        logger.info(f"Comic job {job_id} refined {len(results) - len(failed)} of {len(results)} panels")
+    except asyncio.CancelledError:
+        # Drafts that were not refined yet stay in place, so the preview comic remains valid
+        job_registry.set_state(job_id, "cancelled")
+        metrics["refinements_cancelled"] += 1
+        raise
+    except Exception as e:
+        job_registry.set_state(job_id, "failed")
+        logger.error(f"Error rebuilding refined comic {job_id}: {str(e)}")
+    finally:
+        job_registry.unregister(job_id)
+
+@app.post("/cancel/{job_id}", response_model=ComicResponse)
+async def cancel_job(job_id: str):
+    """Cancel an in-flight comic generation job"""
+    if not job_registry.cancel(job_id, "cancelled by client"):
+        raise HTTPException(status_code=404, detail="Job not found or already finished")
+    return ComicResponse(success=True, message="Comic generation cancelled", job_id=job_id)
+
+@app.get("/jobs/{job_id}", response_model=ComicResponse)
+async def get_job(job_id: str):
+    """Report the state of a draft comic's background refinement"""
+    status = job_registry.get_state(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return ComicResponse(success=True, message=f"Comic job {status}", job_id=job_id, status=status)
+
+@app.get("/metrics")
+async def get_metrics():
+    return dict(metrics)
+
 @app.get("/download/{filename}")
 async def download_file(filename: str):
     temp_dir = tempfile.gettempdir()
@@ -140,9 +340,13 @@ async def download_file(filename: str):
             )
     raise HTTPException(status_code=404, detail="File not found")
 
-async def cleanup_temp_files(temp_dir: str, delay_seconds: int):
+async def cleanup_temp_files(temp_dir: str, delay_seconds: int, job_id: Optional[str] = None):
     """Clean up temporary files after delay"""
     await asyncio.sleep(delay_seconds)
+    if job_id:
+        # Let a still-running refinement record its final state before it is forgotten
+        await job_registry.cancel_and_wait(job_id, "temporary files expired")
+        job_registry.forget(job_id)
     try:
         import shutil
         shutil.rmtree(temp_dir, ignore_errors=True)
@@ -1,66 +1,179 @@
 import os
+import re
 import json
+import asyncio
 import logging
 from typing import List
 import openai
 from dotenv import load_dotenv
 
+from services.tracing import traced
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Panels written per parallel completion once the outline is known
+PANELS_PER_CHUNK = 5
+# Token budgets: one short beat per panel in the outline, a description and
+# dialogue line per panel in each chunk, plus headroom for the JSON wrapper
+OUTLINE_TOKENS_PER_PANEL = 40
+PANEL_TOKENS_PER_PANEL = 150
+TOKEN_OVERHEAD = 100
+
 class ChatGPTService:
     def __init__(self):
         self.api_key = os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OPENAI_API_KEY environment variable is required")
-        
-        self.client = openai.OpenAI(api_key=self.api_key)
-    
+
+        self.client = openai.AsyncOpenAI(api_key=self.api_key)
+
+    @traced()
     async def generate_illustration_prompts(
-        self, 
-        genre: str, 
-        setting: str, 
-        characters: str
+        self,
+        genre: str,
+        setting: str,
+        characters: str,
+        num_panels: int = 10
     ) -> List[dict]:
         """
-        Generate 10 illustration prompts and dialogue using ChatGPT based on user input
+        Generate illustration prompts and dialogue using ChatGPT based on user input.
+        A compact story outline is produced first, then each chunk of the outline
+        is expanded into panels in parallel.
         """
+        if num_panels < 1:
+            raise ValueError("num_panels must be at least 1")
         try:
-            system_prompt = """You are a creative comic book illustrator and storyteller. \
-            Your task is to generate exactly 10 detailed illustration prompts for a comic book.\n\n            For each panel, provide:\n            - 'description': a vivid, visual prompt for AI image generation (1-2 sentences)\n            - 'dialogue': a short line of character dialogue or speech bubble (1 sentence, in quotes)\n\n            Return ONLY a JSON array of 10 objects, each with 'description' and 'dialogue'.\n            Example format: [\n              {\"description\": \"A robot detective in a space station...\", \"dialogue\": \"We have a problem!\"},\n              ...\n            ]\n            No other text.\n            """
-            user_prompt = f"""Create 10 comic panels for:\n            Genre: {genre}\n            Setting: {setting}\n            Characters: {characters}\n\n            Each panel should progress the story.\n            """
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.8,
-                max_tokens=1500
+            outline = await self._retry_once(
+                lambda: self._generate_outline(genre, setting, characters, num_panels),
+                "Outline"
             )
-            content = response.choices[0].message.content.strip()
-            # Try to parse as JSON
+            chunks = [
+                (start, outline[start:start + PANELS_PER_CHUNK])
+                for start in range(0, num_panels, PANELS_PER_CHUNK)
+            ]
+            tasks = [
+                asyncio.create_task(self._retry_once(
+                    lambda start=start, beats=beats: self._generate_panel_chunk(
+                        genre, setting, characters, outline, start, beats
+                    ),
+                    f"Panels {start + 1}-{start + len(beats)}"
+                ))
+                for start, beats in chunks
+            ]
             try:
-                prompts = json.loads(content)
-                if isinstance(prompts, list) and len(prompts) == 10 and all('description' in p and 'dialogue' in p for p in prompts):
-                    logger.info(f"Successfully generated {len(prompts)} prompts with dialogue")
-                    return prompts
-                else:
-                    raise ValueError("Response is not a list of 10 objects with description and dialogue")
-            except json.JSONDecodeError:
-                raise ValueError("Could not parse ChatGPT response as JSON")
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # Don't keep paying for sibling chunks once the request has failed
+                for task in tasks:
+                    task.cancel()
+                raise
+            prompts = [panel for chunk in results for panel in chunk]
+            logger.info(f"Successfully generated {len(prompts)} prompts with dialogue in {len(chunks)} chunks")
+            return prompts
         except Exception as e:
             logger.error(f"Error generating prompts: {str(e)}")
             raise
-    
+
+    @traced()
+    async def _generate_outline(
+        self,
+        genre: str,
+        setting: str,
+        characters: str,
+        num_panels: int
+    ) -> List[str]:
+        """
+        Generate a compact story outline with one short beat per panel
+        """
+        system_prompt = f"""You are a creative comic book storyteller. \
+        Your task is to outline a comic book story in exactly {num_panels} beats, one per panel.\n\n        Each beat is a single short sentence (at most 15 words) describing what happens in that panel.\n\n        Return ONLY a JSON array of {num_panels} strings.\n        No other text.\n        """
+        user_prompt = f"""Outline a {num_panels}-panel comic for:\n        Genre: {genre}\n        Setting: {setting}\n        Characters: {characters}\n\n        The beats should tell a complete story from start to finish.\n        """
+        response = await self.client.chat.completions.create(
+            model="gpt-4",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.8,
+            max_tokens=num_panels * OUTLINE_TOKENS_PER_PANEL + TOKEN_OVERHEAD
+        )
+        outline = self._parse_json_array(response.choices[0].message.content)
+        if len(outline) > num_panels:
+            logger.warning(f"Outline has {len(outline)} beats, truncating to {num_panels}")
+            outline = outline[:num_panels]
+        if len(outline) != num_panels or not all(isinstance(beat, str) for beat in outline):
+            raise ValueError(f"Outline is not a list of {num_panels} strings")
+        return outline
+
+    @traced()
+    async def _generate_panel_chunk(
+        self,
+        genre: str,
+        setting: str,
+        characters: str,
+        outline: List[str],
+        start: int,
+        beats: List[str]
+    ) -> List[dict]:
+        """
+        Expand a slice of the outline into panel descriptions and dialogue
+        """
+        count = len(beats)
+        system_prompt = f"""You are a creative comic book illustrator and storyteller. \
+        Your task is to generate exactly {count} detailed illustration prompts for a comic book.\n\n        For each panel, provide:\n        - 'description': a vivid, visual prompt for AI image generation (1-2 sentences)\n        - 'dialogue': a short line of character dialogue or speech bubble (1 sentence, in quotes)\n\n        Return ONLY a JSON array of {count} objects, each with 'description' and 'dialogue'.\n        Example format: [\n          {{\"description\": \"A robot detective in a space station...\", \"dialogue\": \"We have a problem!\"}},\n          ...\n        ]\n        No other text.\n        """
+        story = "\n".join(f"{i + 1}. {beat}" for i, beat in enumerate(outline))
+        panels = "\n".join(f"{start + i + 1}. {beat}" for i, beat in enumerate(beats))
+        user_prompt = f"""Genre: {genre}\n        Setting: {setting}\n        Characters: {characters}\n\n        Full story outline:\n{story}\n\n        Write panels {start + 1} to {start + count}, one per beat:\n{panels}\n        """
+        response = await self.client.chat.completions.create(
+            model="gpt-4",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.8,
+            max_tokens=count * PANEL_TOKENS_PER_PANEL + TOKEN_OVERHEAD
+        )
+        prompts = self._parse_json_array(response.choices[0].message.content)
+        if len(prompts) == count and all(isinstance(p, dict) and 'description' in p and 'dialogue' in p for p in prompts):
+            return prompts
+        raise ValueError(f"Response for panels {start + 1}-{start + count} is not a list of {count} objects with description and dialogue")
+
+    async def _retry_once(self, make_call, label: str):
+        """
+        Await make_call(), calling it a second time if the first attempt fails
+        """
+        try:
+            return await make_call()
+        except Exception as e:
+            logger.warning(f"{label} generation failed, retrying once: {str(e)}")
+            return await make_call()
+
+    def _parse_json_array(self, content: str) -> list:
+        """
+        Parse a ChatGPT response that should contain only a JSON array,
+        tolerating a surrounding markdown code fence
+        """
+        content = content.strip()
+        fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", content, re.DOTALL)
+        if fenced:
+            content = fenced.group(1)
+        try:
+            parsed = json.loads(content)
+        except json.JSONDecodeError:
+            raise ValueError("Could not parse ChatGPT response as JSON")
+        if not isinstance(parsed, list):
+            raise ValueError("ChatGPT response is not a JSON array")
+        return parsed
+
     def _extract_prompts_from_text(self, text: str) -> List[str]:
         """
         Fallback method to extract prompts from text if JSON parsing fails
         """
         lines = text.split('\n')
         prompts = []
-        
+
         for line in lines:
             line = line.strip()
             if line and not line.startswith('#') and not line.startswith('```'):
@@ -68,7 +181,7 @@ class ChatGPTService:
                 if line[0].isdigit() and '. ' in line:
                     line = line.split('. ', 1)[1]
                 prompts.append(line)
-        
+
         # Ensure we have exactly 10 prompts
         if len(prompts) > 10:
             prompts = prompts[:10]
@@ -76,5 +189,5 @@ class ChatGPTService:
             # Pad with generic prompts if we don't have enough
             while len(prompts) < 10:
                 prompts.append(f"Comic panel {len(prompts) + 1}")
-        
-        return prompts 
\ No newline at end of file
+
+        return prompts
\ No newline at end of file
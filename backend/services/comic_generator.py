@@ -10,10 +10,22 @@ import base64
 from dotenv import load_dotenv
 from PIL import ImageDraw, ImageFont
 
+from services.tracing import traced, span
+from services.jobs import metrics
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+SDXL_VERSION = "39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b"
+REPLICATE_POLL_INTERVAL = 1.0
+
+# Draft renders trade resolution and steps for a fast preview; full renders are the final quality
+RENDER_PRESETS = {
+    "draft": {"width": 512, "height": 512, "num_inference_steps": 10},
+    "full": {"width": 1024, "height": 1024, "num_inference_steps": 30},
+}
+
 class ComicGenerator:
     def __init__(self):
         self.rendering_engine = os.getenv("RENDERING_ENGINE", "REPLICATE")
@@ -27,6 +39,7 @@ class ComicGenerator:
         else:
             self.replicate_client = None
     
+    @traced()
     async def generate_images(self, prompts: List[str], output_dir: str) -> List[str]:
         """
         Generate images from prompts using the configured rendering engine, in parallel
@@ -37,6 +50,7 @@ class ComicGenerator:
         ]
         return await asyncio.gather(*tasks)
     
+    @traced()
     async def _generate_single_image(self, prompt: str, output_dir: str, panel_number: int) -> str:
         """
         Generate a single image using the configured rendering engine
@@ -56,28 +70,39 @@ class ComicGenerator:
             logger.error(f"Error in _generate_single_image: {str(e)}")
             return self._create_placeholder_image(output_dir, panel_number, prompt)
     
-    async def _generate_with_replicate(self, prompt: str, output_dir: str, panel_number: int, dialogue: str = "") -> str:
+    @traced()
+    async def _generate_with_replicate(
+        self,
+        prompt: str,
+        output_dir: str,
+        panel_number: int,
+        dialogue: str = "",
+        preset: str = "full",
+        suffix: str = ""
+    ) -> str:
         """
         Generate image using Replicate API, with comic style and dialogue instructions
         """
         try:
+            settings = RENDER_PRESETS[preset]
             # Use SDXL model for high-quality comic-style images
             full_prompt = f"comic book style, {prompt}, high quality, detailed illustration, speech bubble with dialogue: '{dialogue}'"
-            output = self.replicate_client.run(
-                "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
-                input={
-                    "prompt": full_prompt,
-                    "negative_prompt": "watermark, blurry, low quality",
-                    "width": 1024,
-                    "height": 1024,
-                    "num_outputs": 1,
-                    "guidance_scale": 7.5,
-                    "num_inference_steps": 30
-                }
-            )
+            with span("replicate.run", panel=panel_number, preset=preset):
+                output = await self._run_replicate_prediction(
+                    SDXL_VERSION,
+                    {
+                        "prompt": full_prompt,
+                        "negative_prompt": "watermark, blurry, low quality",
+                        "width": settings["width"],
+                        "height": settings["height"],
+                        "num_outputs": 1,
+                        "guidance_scale": 7.5,
+                        "num_inference_steps": settings["num_inference_steps"]
+                    }
+                )
             if output and len(output) > 0:
                 image_url = output[0]
-                image_path = await self._download_and_save_image(image_url, output_dir, panel_number)
+                image_path = await self._download_and_save_image(image_url, output_dir, panel_number, suffix)
                 if dialogue:
                     self.overlay_speech_bubble(image_path, dialogue)
                 return image_path
@@ -87,6 +112,53 @@ class ComicGenerator:
             logger.error(f"Error generating with Replicate: {str(e)}")
             raise
     
+    @traced()
+    async def refine_panel(self, prompt: str, output_dir: str, panel_number: int, dialogue: str = "") -> str:
+        """
+        Render a full-quality panel next to its draft, then atomically swap it into the draft's path
+        """
+        refined_path = await self._generate_with_replicate(
+            prompt, output_dir, panel_number, dialogue, preset="full", suffix="_refined"
+        )
+        image_path = os.path.join(output_dir, f"panel_{panel_number:02d}.png")
+        os.replace(refined_path, image_path)
+        return image_path
+    
+    async def _run_replicate_prediction(self, version: str, input: dict):
+        """
+        Run a Replicate prediction without blocking the event loop.
+        If the awaiting task is cancelled, the prediction is cancelled on Replicate too.
+        """
+        create = asyncio.ensure_future(asyncio.to_thread(
+            self.replicate_client.predictions.create, version=version, input=input
+        ))
+        try:
+            prediction = await asyncio.shield(create)
+        except asyncio.CancelledError:
+            # The worker thread still creates the prediction, so wait for it and cancel it upstream
+            metrics["provider_calls_cancelled"] += 1
+            try:
+                prediction = await create
+                await asyncio.to_thread(prediction.cancel)
+            except Exception as e:
+                logger.error(f"Error cancelling Replicate prediction: {str(e)}")
+            raise
+        try:
+            while prediction.status not in ("succeeded", "failed", "canceled"):
+                await asyncio.sleep(REPLICATE_POLL_INTERVAL)
+                await asyncio.to_thread(prediction.reload)
+        except asyncio.CancelledError:
+            metrics["provider_calls_cancelled"] += 1
+            try:
+                await asyncio.shield(asyncio.to_thread(prediction.cancel))
+            except Exception as e:
+                logger.error(f"Error cancelling Replicate prediction {prediction.id}: {str(e)}")
+            raise
+        if prediction.status != "succeeded":
+            raise Exception(f"Replicate prediction {prediction.status}: {prediction.error}")
+        return prediction.output
+    
+    @traced()
     async def _generate_with_openai(self, prompt: str, output_dir: str, panel_number: int) -> str:
         """
         Generate image using OpenAI DALL-E API
@@ -96,7 +168,8 @@ class ComicGenerator:
             
             client = openai.OpenAI(api_key=self.openai_api_key)
             
-            response = client.images.generate(
+            response = await asyncio.to_thread(
+                client.images.generate,
                 model="dall-e-3",
                 prompt=f"Comic book style illustration: {prompt}. High quality, detailed, no text or speech bubbles.",
                 size="1024x1024",
@@ -114,6 +187,7 @@ class ComicGenerator:
             logger.error(f"Error generating with OpenAI: {str(e)}")
             raise
     
+    @traced()
     async def _generate_with_huggingface(self, prompt: str, output_dir: str, panel_number: int) -> str:
         """
         Generate image using Hugging Face Inference API
@@ -135,7 +209,7 @@ class ComicGenerator:
                 }
             }
             
-            response = requests.post(API_URL, headers=headers, json=payload)
+            response = await asyncio.to_thread(requests.post, API_URL, headers=headers, json=payload)
             
             if response.status_code == 200:
                 # Save the image directly from the response
@@ -150,18 +224,21 @@ class ComicGenerator:
             logger.error(f"Error generating with Hugging Face: {str(e)}")
             raise
     
-    async def _download_and_save_image(self, image_url: str, output_dir: str, panel_number: int) -> str:
+    @traced()
+    async def _download_and_save_image(self, image_url: str, output_dir: str, panel_number: int, suffix: str = "") -> str:
         """
         Download image from URL and save to local file
         """
         try:
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
+            with span("http.get", panel=panel_number):
+                response = await asyncio.to_thread(requests.get, image_url, timeout=30)
+                response.raise_for_status()
             
-            image_path = os.path.join(output_dir, f"panel_{panel_number:02d}.png")
+            image_path = os.path.join(output_dir, f"panel_{panel_number:02d}{suffix}.png")
             
-            with open(image_path, "wb") as f:
-                f.write(response.content)
+            with span("file.write", panel=panel_number, bytes=len(response.content)):
+                with open(image_path, "wb") as f:
+                    f.write(response.content)
             
             return image_path
             
@@ -169,6 +246,7 @@ class ComicGenerator:
             logger.error(f"Error downloading image: {str(e)}")
             raise
     
+    @traced()
     def _create_placeholder_image(self, output_dir: str, panel_number: int, prompt: str) -> str:
         """
         Create a placeholder image when generation fails
@@ -206,6 +284,7 @@ class ComicGenerator:
             # Return a path even if creation fails
             return os.path.join(output_dir, f"panel_{panel_number:02d}.png")
     
+    @traced()
     def overlay_speech_bubble(self, image_path: str, dialogue: str):
         """
         Overlay a simple speech bubble with dialogue on the image using PIL
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Process-wide counters exposed on /metrics
+metrics = Counter()
+
+class JobRegistry:
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.cancel_reasons: Dict[str, str] = {}
+        # Last known state of jobs that outlive their request, e.g. background refinement
+        self.states: Dict[str, str] = {}
+
+    def register(self, job_id: str, task: asyncio.Task):
+        if job_id in self.tasks:
+            raise ValueError(f"Job {job_id} is already running")
+        self.tasks[job_id] = task
+
+    def unregister(self, job_id: str):
+        self.tasks.pop(job_id, None)
+        self.cancel_reasons.pop(job_id, None)
+
+    def cancel(self, job_id: str, reason: str) -> bool:
+        """
+        Cancel a running job; returns False if it is unknown or already finished
+        """
+        task = self.tasks.get(job_id)
+        if task is None or task.done():
+            return False
+        self.cancel_reasons.setdefault(job_id, reason)
+        task.cancel()
+        logger.info(f"Cancelling job {job_id}: {reason}")
+        return True
+
+    async def cancel_and_wait(self, job_id: str, reason: str):
+        """
+        Cancel a running job and wait until it has finished handling the cancellation
+        """
+        task = self.tasks.get(job_id)
+        if self.cancel(job_id, reason):
+            await asyncio.wait([task])
+
+    def cancel_reason(self, job_id: str) -> Optional[str]:
+        return self.cancel_reasons.get(job_id)
+
+    def set_state(self, job_id: str, state: str):
+        self.states[job_id] = state
+
+    def get_state(self, job_id: str) -> Optional[str]:
+        return self.states.get(job_id)
+
+    def forget(self, job_id: str):
+        self.states.pop(job_id, None)
+
+    async def watch_disconnect(self, job_id: str, request, interval: float = 1.0):
+        """
+        Poll the HTTP connection and cancel the job once the client goes away
+        """
+        while job_id in self.tasks:
+            if await request.is_disconnected():
+                self.cancel(job_id, "client disconnected")
+                return
+            await asyncio.sleep(interval)
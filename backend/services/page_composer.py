@@ -0,0 +1,144 @@
+import os
+import random
+import asyncio
+import logging
+from typing import List
+import numpy as np
+from PIL import Image
+
+from services.tracing import traced, span
+
+logger = logging.getLogger(__name__)
+
+# Page layouts mirrored from src/app/layouts/index.tsx.
+# Each slot is (col, row, col_span, row_span) on the layout's grid, zero-based.
+LAYOUTS = {
+    "Layout0": {
+        "cols": 2, "rows": 2,
+        "slots": [(0, 0, 1, 1), (1, 0, 1, 1), (0, 1, 1, 1), (1, 1, 1, 1)]
+    },
+    "Layout1": {
+        "cols": 2, "rows": 3,
+        "slots": [(0, 0, 1, 1), (1, 0, 1, 2), (0, 1, 1, 2), (1, 2, 1, 1)]
+    },
+    "Layout2": {
+        "cols": 3, "rows": 2,
+        "slots": [(0, 0, 1, 1), (1, 0, 1, 1), (2, 0, 1, 2), (0, 1, 2, 1)]
+    },
+    "Layout3": {
+        "cols": 3, "rows": 2,
+        "slots": [(0, 0, 2, 1), (2, 0, 1, 1), (0, 1, 1, 1), (1, 1, 2, 1)]
+    },
+    "Layout4": {
+        "cols": 8, "rows": 8,
+        "slots": [(0, 0, 6, 2), (2, 2, 6, 1), (1, 3, 6, 2), (0, 5, 8, 2)]
+    },
+}
+
+DEFAULT_LAYOUT = "Layout1"
+# Pages are encoded once as JPEG: the PDF embeds that data as-is, where PNG would be decoded and recompressed
+PAGE_JPEG_QUALITY = 90
+
+class PageComposer:
+    def __init__(
+        self,
+        page_width: int = 1500,
+        page_height: int = 2121,  # A4 portrait (210/297), so PDF exports fill the sheet
+        margin: int = 36,
+        gutter: int = 16,
+        border: int = 4,
+        background=(255, 255, 255),
+        border_color=(0, 0, 0)
+    ):
+        self.page_width = page_width
+        self.page_height = page_height
+        self.margin = margin
+        self.gutter = gutter
+        self.border = border
+        self.background = np.array(background, dtype=np.uint8)
+        self.border_color = np.array(border_color, dtype=np.uint8)
+
+    @traced()
+    async def compose_pages(
+        self,
+        image_paths: List[str],
+        output_dir: str,
+        layout: str = DEFAULT_LAYOUT
+    ) -> List[str]:
+        """
+        Arrange panels into page images using the given layout, composing pages in parallel.
+        "random" picks a different layout for each page.
+        """
+        if layout != "random" and layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout: {layout}")
+        pages = []
+        index = 0
+        while index < len(image_paths):
+            page_layout = random.choice(list(LAYOUTS)) if layout == "random" else layout
+            count = len(LAYOUTS[page_layout]["slots"])
+            pages.append((page_layout, image_paths[index:index + count]))
+            index += count
+        logger.info(f"Composing {len(image_paths)} panels into {len(pages)} pages")
+        return await asyncio.gather(*[
+            asyncio.to_thread(
+                self.compose_page,
+                panels,
+                os.path.join(output_dir, f"page_{page_number:02d}.jpg"),
+                page_layout
+            )
+            for page_number, (page_layout, panels) in enumerate(pages, start=1)
+        ])
+
+    def compose_page(self, image_paths: List[str], output_path: str, layout: str = DEFAULT_LAYOUT) -> str:
+        """
+        Compose one page: each panel is cropped and scaled to its slot by Pillow,
+        then written into a single page array along with its border
+        """
+        with span("compose_page", layout=layout, panels=len(image_paths)):
+            page = np.empty((self.page_height, self.page_width, 3), dtype=np.uint8)
+            page[:] = self.background
+            for image_path, (x0, y0, x1, y1) in zip(image_paths, self._slot_rects(layout)):
+                b = self.border
+                page[y0:y1, x0:x1] = self.border_color
+                page[y0 + b:y1 - b, x0 + b:x1 - b] = self._fit_panel(image_path, x1 - x0 - 2 * b, y1 - y0 - 2 * b)
+            Image.fromarray(page).save(output_path, "JPEG", quality=PAGE_JPEG_QUALITY)
+            return output_path
+
+    def _slot_rects(self, layout: str) -> List[tuple]:
+        """
+        Pixel rectangles (x0, y0, x1, y1) for each slot of a layout
+        """
+        definition = LAYOUTS[layout]
+        cols, rows = definition["cols"], definition["rows"]
+        cell_w = (self.page_width - 2 * self.margin - (cols - 1) * self.gutter) / cols
+        cell_h = (self.page_height - 2 * self.margin - (rows - 1) * self.gutter) / rows
+        rects = []
+        for col, row, col_span, row_span in definition["slots"]:
+            x0 = self.margin + col * (cell_w + self.gutter)
+            y0 = self.margin + row * (cell_h + self.gutter)
+            x1 = x0 + col_span * cell_w + (col_span - 1) * self.gutter
+            y1 = y0 + row_span * cell_h + (row_span - 1) * self.gutter
+            rects.append((round(x0), round(y0), round(x1), round(y1)))
+        return rects
+
+    def _fit_panel(self, image_path: str, width: int, height: int) -> np.ndarray:
+        """
+        Center-crop a panel to the slot's aspect ratio and scale it in a single resize
+        """
+        try:
+            with Image.open(image_path) as image:
+                image = image.convert("RGB")
+                src_w, src_h = image.size
+                scale = max(width / src_w, height / src_h)
+                crop_w, crop_h = width / scale, height / scale
+                left, top = (src_w - crop_w) / 2, (src_h - crop_h) / 2
+                fitted = image.resize(
+                    (width, height),
+                    resample=Image.LANCZOS,
+                    box=(left, top, left + crop_w, top + crop_h)
+                )
+                return np.asarray(fitted)
+        except Exception as e:
+            logger.error(f"Error fitting panel {image_path}: {str(e)}")
+            # Leave the slot blank rather than dropping the whole page
+            return self.background
@@ -10,6 +10,8 @@ from reportlab.platypus import SimpleDocTemplate, Image as RLImage, Paragraph, S
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 
+from services.tracing import traced
+
 logger = logging.getLogger(__name__)
 
 class PDFGenerator:
@@ -19,6 +21,7 @@ class PDFGenerator:
         self.image_width = 3 * inch
         self.image_height = 3 * inch
         
+    @traced()
     async def create_comic_pdf(
         self, 
         image_paths: List[str], 
@@ -31,6 +34,7 @@ class PDFGenerator:
         # Use the simple grid layout for all comics
         return self.create_simple_comic_pdf(image_paths, prompts, output_path)
     
+    @traced()
     def create_simple_comic_pdf(
         self, 
         image_paths: List[str], 
@@ -96,6 +100,31 @@ class PDFGenerator:
             logger.error(f"Error creating simple comic PDF: {str(e)}")
             raise
     
+    @traced()
+    def create_pages_pdf(self, page_paths: List[str], output_path: str) -> str:
+        """
+        Create a PDF with one composed comic page image per A4 page
+        """
+        try:
+            logger.info(f"Creating comic PDF from {len(page_paths)} composed pages")
+            
+            c = canvas.Canvas(output_path, pagesize=A4)
+            width, height = A4
+            
+            for page_path in page_paths:
+                # Composed pages are A4 JPEGs with their own margin: drawn edge to edge and embedded without re-encoding
+                c.drawImage(page_path, 0, 0, width=width, height=height)
+                c.showPage()
+            
+            c.save()
+            logger.info(f"Comic pages PDF created: {output_path}")
+            return output_path
+            
+        except Exception as e:
+            logger.error(f"Error creating comic pages PDF: {str(e)}")
+            raise
+    
+    @traced()
     def create_placeholder_pdf(self, output_path: str, prompts: List[str]) -> str:
         """
         Create a placeholder PDF when image generation fails
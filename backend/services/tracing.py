@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import inspect
+import logging
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[int]] = ContextVar("current_span", default=None)
+
+class Trace:
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.ended = None
+        self.spans = []
+        self._next_id = 0
+
+    def new_span_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def to_dict(self) -> dict:
+        """
+        Span timeline relative to the start of the request, in milliseconds.
+        The total duration runs until the trace ended, or until now while it is still open.
+        """
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(((self.ended or time.perf_counter()) - self.origin) * 1000, 2),
+            "spans": sorted(self.spans, key=lambda s: s["start_ms"])
+        }
+
+    def export(self, path: str) -> str:
+        """
+        Write the trace in Chrome trace event format (chrome://tracing, Perfetto)
+        """
+        events = [
+            {
+                "name": s["name"],
+                "ph": "X",
+                "ts": s["start_ms"] * 1000,
+                "dur": s["duration_ms"] * 1000,
+                "pid": 1,
+                "tid": s["task"],
+                "args": {**s["attrs"], "id": s["id"], "parent": s["parent"]}
+            }
+            for s in self.spans
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "otherData": {"trace_id": self.trace_id, "name": self.name}}, f)
+        return path
+
+@contextmanager
+def start_trace(name: str):
+    """
+    Start a new trace for the current request; spans opened inside it are recorded
+    """
+    trace = Trace(name)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        with span(name):
+            yield trace
+    finally:
+        trace.ended = time.perf_counter()
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Record a timed span in the current trace; a no-op outside of a trace
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    record = {
+        "id": trace.new_span_id(),
+        "parent": _current_span.get(),
+        "name": name,
+        "task": _task_name(),
+        "attrs": attrs,
+        "start_ms": round((time.perf_counter() - trace.origin) * 1000, 2),
+    }
+    token = _current_span.set(record["id"])
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["attrs"]["error"] = str(e) or type(e).__name__
+        raise
+    finally:
+        record["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        trace.spans.append(record)
+        _current_span.reset(token)
+
+def traced(name: Optional[str] = None):
+    """
+    Decorator recording a span around a sync or async function
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    """
+    Periodically samples the stacks of every thread from a background thread and
+    aggregates them as collapsed stacks (flamegraph.pl / speedscope format), each
+    rooted at its thread name. Provider calls, downloads and PDF/page rendering run
+    in worker threads, so those are included alongside the event loop thread.
+    Other requests running at the same time show up in the samples too.
+    """
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, f"thread-{thread_id}"))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def dump(self, path: str) -> str:
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+@contextmanager
+def profile_to(path: str):
+    """
+    Sample all threads while the enclosed block runs and write the
+    collapsed stacks to path
+    """
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        yield path
+    finally:
+        profiler.stop()
+        profiler.dump(path)
+        logger.info(f"Profile saved: {path} ({sum(profiler.samples.values())} samples)")
+
+def is_profiling_requested(flag: Optional[str]) -> bool:
+    """
+    Profiling is opt-in per request, or for every request via PROFILE_REQUESTS
+    """
+    if flag is not None:
+        return flag.strip().lower() in ("1", "true", "yes", "on")
+    return os.getenv("PROFILE_REQUESTS", "").strip().lower() in ("1", "true", "yes", "on")
+
+def _task_name() -> str:
+    try:
+        task = asyncio.current_task()
+        if task is not None:
+            return task.get_name()
+    except RuntimeError:
+        pass
+    return threading.current_thread().name